@@ -4,6 +4,22 @@ import streamlit as st
 import requests
 from bs4 import BeautifulSoup
 import re
+from collections import namedtuple
+
+# Compiled once and shared by every page/handler that needs an NCT ID from a URL
+NCT_ID_PATTERN = re.compile(r'NCT\d+')
+PMC_ID_PATTERN = re.compile(r'(PMC\d+)')
+# Domain test used wherever CT.gov links are routed away from the PubMed workflow
+CT_GOV_DOMAIN = "clinicaltrials.gov"
+CT_GOV_HEADERS = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) Chrome/91.0.4472.124'}
+
+# A document's chunks as parallel lists: texts[i] came from section sections[i]
+Chunks = namedtuple("Chunks", ["texts", "sections"])
+
+def extract_nct_id(url):
+    """Returns the NCT ID contained in a ClinicalTrials.gov URL, or None."""
+    nct_match = NCT_ID_PATTERN.search(url)
+    return nct_match.group(0) if nct_match else None
 
 # --- 1. PMC API Fetching Logic ---
 
@@ -145,12 +161,9 @@ def parse_clinical_trial_record(nct_id):
     Fetches and parses a ClinicalTrials.gov study and returns a list of (section, text) tuples.
     """
     if not nct_id: return [], "No NCT ID provided."
-    api_url = f"https://clinicaltrials.gov/api/v2/studies/{nct_id}"
     try:
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) Chrome/91.0.4472.124'}
-        response = requests.get(api_url, headers=headers, timeout=15)
-        response.raise_for_status()
-        data = response.json()
+        # Shares the cached record with the table-title and extraction helpers below
+        data = fetch_ct_gov_study(nct_id)
         sections_data = []
         protocol = data.get('protocolSection', {})
         title = protocol.get('identificationModule', {}).get('officialTitle') or protocol.get('identificationModule', {}).get('briefTitle', 'No Title Found')
@@ -174,17 +187,25 @@ def parse_clinical_trial_record(nct_id):
         print(f"API request failed for NCT ID {nct_id}: {e}")
         return [], f"API request failed: {str(e)}"
 
+@st.cache_data(ttl=3600, show_spinner=False)
+def fetch_ct_gov_study(nct_id):
+    """
+    Fetches the full study record JSON from the CT.gov API.
+    Cached per NCT ID, so repeated button clicks don't re-hit the API.
+    Raises on failure (exceptions are never cached).
+    """
+    api_url = f"https://clinicaltrials.gov/api/v2/studies/{nct_id}"
+    response = requests.get(api_url, headers=CT_GOV_HEADERS, timeout=20)
+    response.raise_for_status()
+    return response.json()
+
 def get_ct_gov_table_titles_from_api(nct_id):
     """
     Fetches a full study record from the CT.gov API and returns a list of all
     table titles from the Baseline, Outcome, and Adverse Event sections.
     """
-    api_url = f"https://clinicaltrials.gov/api/v2/studies/{nct_id}"
     try:
-        headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) Chrome/91.0.4472.124'}
-        response = requests.get(api_url, headers=headers, timeout=20)
-        response.raise_for_status()
-        data = response.json()
+        data = fetch_ct_gov_study(nct_id)
 
         results_section = data.get('resultsSection', {})
         if not results_section:
@@ -233,18 +254,26 @@ def extract_data_for_selected_titles(nct_id, selected_titles):
     Fetches API data and extracts values AND time frames.
     Returns a dict: {title: {'value': "...", 'time_frame': "..."}}
     """
-    api_url = f"https://clinicaltrials.gov/api/v2/studies/{nct_id}"
     try:
-        headers = {'User-Agent': 'Mozilla/5.0'}
-        response = requests.get(api_url, headers=headers, timeout=20)
-        response.raise_for_status()
-        data = response.json()
+        # One (cached) fetch per study, however many titles were selected
+        data = fetch_ct_gov_study(nct_id)
         
         results = data.get('resultsSection', {})
         if not results: return None, "No results section."
 
         extracted_results = {}
 
+        # Index each table by its title once, instead of scanning the lists per selected title.
+        # setdefault keeps the first match, like the next(...) lookups this replaces.
+        baseline_by_title, outcome_by_title, event_by_term = {}, {}, {}
+        for m in results.get('baselineCharacteristicsModule', {}).get('measures', []):
+            baseline_by_title.setdefault(m.get('title'), m)
+        for m in results.get('outcomeMeasuresModule', {}).get('outcomeMeasures', []):
+            outcome_by_title.setdefault(m.get('title'), m)
+        adverse_module = results.get('adverseEventsModule', {})
+        for e in adverse_module.get('seriousEvents', []) + adverse_module.get('otherEvents', []):
+            event_by_term.setdefault(e.get('term'), e)
+
         for full_title in selected_titles:
             if "] " not in full_title: continue
             tag, clean_title = full_title.split("] ", 1)
@@ -259,7 +288,7 @@ def extract_data_for_selected_titles(nct_id, selected_titles):
                 module = results.get('baselineCharacteristicsModule', {})
                 groups = module.get('groups', [])
                 group_map = {g.get('id'): g.get('title', g.get('id')) for g in groups}
-                measure = next((m for m in module.get('measures', []) if m.get('title') == clean_title), None)
+                measure = baseline_by_title.get(clean_title)
                 
                 if measure:
                     for cls in measure.get('classes', []):
@@ -273,8 +302,7 @@ def extract_data_for_selected_titles(nct_id, selected_titles):
 
             # --- CASE 2: OUTCOME MEASURES ---
             elif tag == "[Outcome]":
-                module = results.get('outcomeMeasuresModule', {})
-                measure = next((m for m in module.get('outcomeMeasures', []) if m.get('title') == clean_title), None)
+                measure = outcome_by_title.get(clean_title)
                 
                 if measure:
                     # --- NEW: Extract Time Frame ---
@@ -294,7 +322,7 @@ def extract_data_for_selected_titles(nct_id, selected_titles):
 
             # --- CASE 3: ADVERSE EVENTS ---
             elif tag.startswith("[Adverse"):
-                module = results.get('adverseEventsModule', {})
+                module = adverse_module
                 # --- NEW: Extract Time Frame ---
                 time_frame = module.get('timeFrame', 'N/A')
                 # -------------------------------
@@ -310,8 +338,7 @@ def extract_data_for_selected_titles(nct_id, selected_titles):
                             val = f"{count}/{at_risk}" if at_risk else f"{count}"
                             findings.append(f"{group_map.get(gid, gid)}: {val}")
                 else:
-                    event_list = module.get('seriousEvents', []) + module.get('otherEvents', [])
-                    event = next((e for e in event_list if e.get('term') == clean_title), None)
+                    event = event_by_term.get(clean_title)
                     if event:
                         for stat in event.get('stats', []):
                             gid = stat.get('groupId')
@@ -334,9 +361,13 @@ def extract_data_for_selected_titles(nct_id, selected_titles):
 # --- 3. Main Controller (Updated) ---
 
 def chunk_text(sections_data, chunk_size=1500, chunk_overlap=200):
-    """Splits text from sections into chunks, each with metadata."""
-    if not sections_data: return []
-    all_chunks = []
+    """
+    Splits text from sections into chunks.
+    Returns a Chunks(texts, sections) of parallel lists rather than one dict per chunk.
+    """
+    texts, sections = [], []
+    all_chunks = Chunks(texts, sections)
+    if not sections_data: return all_chunks
     for section_title, section_text in sections_data:
         if not section_text.strip(): continue
         current_chunk = ""
@@ -346,9 +377,13 @@ def chunk_text(sections_data, chunk_size=1500, chunk_overlap=200):
             if len(current_chunk) + len(para) + 2 <= chunk_size:
                 current_chunk += para + "\n\n"
             else:
-                if current_chunk: all_chunks.append({"text": current_chunk.strip(), "section": section_title})
+                if current_chunk:
+                    texts.append(current_chunk.strip())
+                    sections.append(section_title)
                 current_chunk = para + "\n\n"
-        if current_chunk.strip(): all_chunks.append({"text": current_chunk.strip(), "section": section_title})
+        if current_chunk.strip():
+            texts.append(current_chunk.strip())
+            sections.append(section_title)
     return all_chunks
 
 def process_single_link(url):
@@ -362,7 +397,7 @@ def process_single_link(url):
     # --- PMC Logic (Updated to use API) ---
     if "ncbi.nlm.nih.gov/pmc/articles" in url or "pmc.ncbi.nlm.nih.gov" in url:
         # Extract PMC ID (e.g., PMC12345678)
-        pmc_match = re.search(r'(PMC\d+)', url)
+        pmc_match = PMC_ID_PATTERN.search(url)
         if pmc_match:
             pmc_id = pmc_match.group(1)
             xml_content = fetch_pmc_xml(pmc_id)
@@ -374,9 +409,9 @@ def process_single_link(url):
 
     # --- ClinicalTrials.gov Logic (Unchanged) ---
     elif "clinicaltrials.gov/study" in url:
-        nct_match = re.search(r'NCT\d+', url)
-        if not nct_match: return None, "Could not extract NCT ID."
-        sections_data, status = parse_clinical_trial_record(nct_match.group(0))
+        nct_id = extract_nct_id(url)
+        if not nct_id: return None, "Could not extract NCT ID."
+        sections_data, status = parse_clinical_trial_record(nct_id)
         
     else:
         return None, "Unrecognized URL."
@@ -3,92 +3,150 @@
 import streamlit as st
 #import os
 from data_ingestor import process_single_link
-from query_handler import generate_outcome_table
-# from vector_store_manager import create_vector_store, load_vector_store
-# from vector_store_manager import clear_vector_store
-from vector_store_manager import add_to_in_memory_vector_store, clear_in_memory_vector_store
-from data_ingestor import get_ct_gov_table_titles_from_api
+from query_handler import generate_outcome_table, find_similar_outcome_table, remember_outcome_table
+from query_handler import extract_outcome_from_doc, analyze_outcome_data, find_relevant_table_titles
+from query_handler import generate_ct_gov_table, process_single_ct_gov_doc
+from vector_store_manager import add_to_in_memory_vector_store, clear_in_memory_vector_store, get_embedding_model
+from vector_store_manager import get_library_source_set, get_library_chunk_count
+from data_ingestor import get_ct_gov_table_titles_from_api, extract_data_for_selected_titles, extract_nct_id, CT_GOV_DOMAIN
 import time
+from concurrent.futures import ThreadPoolExecutor, wait
 
 st.set_page_config(layout="wide")
 st.title("📄 Paper Analysis and Ingestion")
 st.markdown("Process papers and add them to a temporary, in-memory knowledge library for this session.")
 
 # --- NEW: Display persisted status messages ---
-if "status_message" in st.session_state and st.session_state.status_message:
-    message_type, text = st.session_state.status_message
+# Popped, so the message is read and cleared in one step and doesn't show up again
+status_message = st.session_state.pop("status_message", None)
+if status_message:
+    message_type, text = status_message
     if message_type == "success":
         st.success(text)
     elif message_type == "error":
         st.error(text)
-    # Clear the message after displaying it so it doesn't show up again
-    del st.session_state.status_message
 # --- END NEW ---
 
-# --- Initialize session state for this page ---
-if 'processed_text' not in st.session_state:
-    st.session_state['processed_text'] = None
-if 'processed_chunks' not in st.session_state:
-    st.session_state['processed_chunks'] = None
-if 'processed_link' not in st.session_state:
-    st.session_state['processed_link'] = ""
-
-# # --- 1. Vector Store Management UI ---
-# st.header("1. Knowledge Library Status")
+# --- Background jobs for long-running library scans ---
+# Long scans run on a shared worker pool so they don't freeze this session (or
+# starve other sessions) while the LLM works through every document. Its size is
+# the one cap on concurrent table jobs across all sessions.
+@st.cache_resource
+def get_background_executor():
+    return ThreadPoolExecutor(max_workers=4)
+
+def submit_background_job(job_key, fn, *args, **kwargs):
+    """Submits fn to the background pool and tracks it in session state under job_key."""
+    job = {"progress": (0.0, "Starting...")}
+
+    def on_progress(value, text=None):
+        # Runs on the worker thread, so only touch the job dict, never st.*
+        job["progress"] = (value, text)
+
+    job["future"] = get_background_executor().submit(fn, *args, on_progress=on_progress, **kwargs)
+    st.session_state[job_key] = job
+
+def poll_background_job(job_key):
+    """
+    Returns the job's result once it has finished (and forgets the job), or None
+    while it is still running. Intended to be called from a polling st.fragment.
+    """
+    job = st.session_state.get(job_key)
+    if job is None:
+        return None
+    if not job["future"].done():
+        value, text = job["progress"]
+        st.progress(value, text=text)
+        return None
+    del st.session_state[job_key]
+    return job["future"].result()
+
+# Session keys that belong to one summary-table job; dropped together when the job
+# ends, fails or its library is cleared, so a stale job is never picked up again.
+SUMMARY_TABLE_JOB_KEYS = ('summary_table_job', 'summary_table_partial_rows', 'summary_table_outcome',
+                          'summary_table_outcome_key', 'summary_table_doc_count')
+
+def forget_summary_table_job():
+    """Cancels the summary-table job if it hasn't started and drops its session keys."""
+    job = st.session_state.get('summary_table_job')
+    if job is not None:
+        job["future"].cancel()
+    for key in SUMMARY_TABLE_JOB_KEYS:
+        st.session_state.pop(key, None)
+
+# The embedding prefetch gets its own small pool, so it never queues behind the
+# minutes-long table jobs above.
+@st.cache_resource
+def get_prefetch_executor():
+    return ThreadPoolExecutor(max_workers=2)
+# --- END Background jobs ---
+
+def get_library_sources(vector_store):
+    """Returns (all_sources, ct_sources) for the documents in the library."""
+    all_sources = sorted(get_library_source_set(vector_store))
+    # all_sources is already unique and sorted, so filter it rather than re-scanning metadatas
+    ct_sources = [source for source in all_sources if CT_GOV_DOMAIN in source]
+    return all_sources, ct_sources
+
+# Fetching + parsing + chunking a paper is the most expensive step on the page and
+# depends only on the URL, so results are shared across reruns and sessions.
+# In-memory with a TTL rather than persist="disk": Streamlit ignores ttl for disk
+# caches, and CT.gov records do change when results get posted.
+# Only the chunks are kept: the full text is never used after chunking.
+@st.cache_data(show_spinner=False, ttl=24 * 3600, max_entries=200)
+def _process_link_cached(link):
+    full_text, text_chunks = process_single_link(link)
+    return bool(full_text), text_chunks
+
+def process_link(link):
+    """
+    Returns (ok, chunks_or_error) for a link: its Chunks, or process_single_link's
+    error message. Successful results are cached; failures are retried next time.
+    """
+    ok, text_chunks = _process_link_cached(link)
+    if not ok:
+        _process_link_cached.clear(link)
+    return ok, text_chunks
+
+def get_chunk_preview_items(preview_chunks):
+    """Builds (expander_title, section, text) for the chunk preview."""
+    items = []
+    for i, (chunk_section, chunk_text) in enumerate(preview_chunks):
+        expander_title = f"Chunk {i+1} from Section: '{chunk_section}' (First 100 chars: '{chunk_text[:100].strip()}...')"
+        items.append((expander_title, chunk_section, chunk_text))
+    return items
 
-# vector_store = load_vector_store()
-# if vector_store:
-#     doc_count = vector_store._collection.count()
-#     st.success(f"✅ Knowledge Library is active and contains **{doc_count}** document chunks.")
-    
-#     # Get the list of unique source documents in the library
-#     all_docs_metadata = vector_store.get(include=["metadatas"])
-#     sources_in_library = sorted(list(set(meta['source'] for meta in all_docs_metadata['metadatas'])))
-    
-#     with st.expander("View documents currently in the library"):
-#         for source in sources_in_library:
-#             st.text(source)
-
-#     if st.button("Clear Knowledge Library"):
-#         success, message = clear_vector_store()
-#         if success:
-#             st.success(message)
-#             # Clear any processed data from the session and rerun to reflect the change
-#             st.session_state['processed_text'] = None
-#             st.session_state['processed_chunks'] = None
-#             st.session_state['processed_link'] = ""
-#             st.rerun()
-#         else:
-#             st.error(message)
-# else:
-#     st.warning("⚠️ No Knowledge Library found. Process and add documents below to create one.")
+# --- Initialize session state for this page ---
+for key, default in (('processed_chunks', None), ('processed_link', "")):
+    st.session_state.setdefault(key, default)
 
 # --- 1. Knowledge Library Status ---
 st.header("1. Knowledge Library Status")
 
 # Load the store directly from session state
 vector_store = st.session_state.get('vector_store', None)
+# Computed once per run and reused by every section below
+sources_in_library, ct_sources = get_library_sources(vector_store) if vector_store else ([], [])
+doc_count = get_library_chunk_count(vector_store) if vector_store else 0
 if vector_store:
-    doc_count = vector_store._collection.count()
     st.success(f"✅ In-memory library is active and contains **{doc_count}** document chunks.")
     
-    all_docs_metadata = vector_store.get(include=["metadatas"])
-    sources_in_library = sorted(list(set(meta['source'] for meta in all_docs_metadata['metadatas'])))
-    
     with st.expander("View documents currently in the library"):
         for source in sources_in_library:
             st.text(source)
 
-    if st.button("Clear Knowledge Library"):
+    # A callback, so the cleared library shows on this run
+    def clear_library():
         success, message = clear_in_memory_vector_store()
+        forget_summary_table_job()
         if success:
-            st.session_state['processed_text'] = None
             st.session_state['processed_chunks'] = None
             st.session_state['processed_link'] = ""
             st.session_state.status_message = ("success", message)
-            st.rerun()  # <-- Force a UI refresh
         else:
-            st.error(message)
+            st.session_state.status_message = ("error", message)
+
+    st.button("Clear Knowledge Library", on_click=clear_library)
 else:
     st.warning("⚠️ No Knowledge Library found for this session. Process and add a document below.")
 
@@ -103,7 +161,8 @@ else:
     st.info(f"Found {len(links)} links prepared from the search page.")
 
     # --- NEW: Batch Processing Button ---
-    if st.button("🚀 Process & Add ALL Links to Library"):
+    # A callback; the result shows through status_message on this run
+    def add_all_links():
         progress_bar = st.progress(0, text="Starting batch processing...")
         total_links = len(links)
         success_count = 0
@@ -113,9 +172,10 @@ else:
             
             # 1. Process (Ingest & Chunk)
             # We don't need to display the text here, just get the chunks
-            _, text_chunks = process_single_link(link)
+            ok, text_chunks = process_link(link)
             
-            if text_chunks:
+            # On failure text_chunks is the error message; an empty Chunks tuple is still truthy
+            if ok and text_chunks.texts:
                 # 2. Add to Vector Store
                 vs, status = add_to_in_memory_vector_store(text_chunks, link)
                 if vs:
@@ -126,23 +186,28 @@ else:
                 st.error(f"Failed to process {link}")
         
         progress_bar.empty()
-        st.success(f"Batch complete! Successfully added {success_count}/{total_links} documents to the library.")
-        time.sleep(1) # Give user a moment to see the success message
-        st.rerun()
+        st.session_state.status_message = ("success", f"Batch complete! Successfully added {success_count}/{total_links} documents to the library.")
+
+    st.button("🚀 Process & Add ALL Links to Library", on_click=add_all_links)
     # --- END NEW ---
     selected_link = st.selectbox("Choose a link to process:", options=links)
 
     if st.button(f"Process Link"):
         with st.spinner(f"Fetching and parsing content from {selected_link}..."):
-            full_text, text_chunks = process_single_link(selected_link)
-            if full_text and text_chunks:
-                st.session_state['processed_text'] = full_text
+            ok, text_chunks = process_link(selected_link)
+            if ok and text_chunks.texts:
                 st.session_state['processed_chunks'] = text_chunks
+                # Start embedding while the user reads the preview; the add step then
+                # finds the vectors in the embedding model's content-hash cache.
+                embedding_model = get_embedding_model()
+                if embedding_model:
+                    st.session_state['embed_future'] = get_prefetch_executor().submit(
+                        embedding_model.embed_documents, text_chunks.texts
+                    )
                 st.session_state['processed_link'] = selected_link
                 st.success("Successfully processed the document! You can now add it to the Vector Store below.")
             else:
-                st.error(f"Failed to process the link. Reason: {text_chunks}")
-                st.session_state['processed_text'] = None
+                st.error(f"Failed to process the link. Reason: {text_chunks if not ok else 'no text chunks were produced.'}")
                 st.session_state['processed_chunks'] = None
                 st.session_state['processed_link'] = ""
 
@@ -152,34 +217,44 @@ if st.session_state.get('processed_chunks'):
     st.header("3. Add Processed Document to Knowledge Library")
     
     st.subheader("Extracted Text Chunks (Preview)")
-    st.write(f"The following document produced **{len(st.session_state['processed_chunks'])}** text chunks.")
-    for i, chunk_data in enumerate(st.session_state['processed_chunks'][:3]):
-        chunk_text = chunk_data.get("text", "")
-        chunk_section = chunk_data.get("section", "Unknown")
-        expander_title = f"Chunk {i+1} from Section: '{chunk_section}' (First 100 chars: '{chunk_text[:100].strip()}...')"
+    processed_chunks = st.session_state['processed_chunks']
+    st.write(f"The following document produced **{len(processed_chunks.texts)}** text chunks.")
+    preview_chunks = zip(processed_chunks.sections[:3], processed_chunks.texts[:3])
+    for expander_title, chunk_section, chunk_text in get_chunk_preview_items(preview_chunks):
         with st.expander(expander_title):
             st.write(f"**Section:** {chunk_section}")
             st.markdown("---")
             st.write(chunk_text)
 
-    if st.button("Add Chunks to Knowledge Library"):
+    # A callback, so Section 1 shows the grown library on this run
+    def add_processed_chunks():
         start_time = time.time()
         with st.spinner("Embedding chunks via OpenRouter and updating vector store..."):
+            embed_future = st.session_state.pop('embed_future', None)
+            # A prefetch that hasn't started is dropped; one already running is allowed to
+            # finish rather than embedding the same chunks twice
+            if embed_future is not None and not embed_future.cancel():
+                wait([embed_future], timeout=60)
+            # Only moves if the prefetch didn't cover every chunk. A failed prefetch is
+            # not reported itself: the add embeds what's missing and reports any error.
+            progress_bar = st.progress(0, text="Embedding chunks...")
             vs, status = add_to_in_memory_vector_store(
                 st.session_state['processed_chunks'], 
-                st.session_state['processed_link']
+                st.session_state['processed_link'],
+                on_progress=progress_bar.progress
             )
+            progress_bar.empty()
             end_time = time.time()
             duration = end_time - start_time
             if vs:
                 success_message = f"{status} (Took {duration:.2f} seconds)"
                 st.session_state.status_message = ("success", success_message)
-                st.session_state['processed_text'] = None
                 st.session_state['processed_chunks'] = None
                 st.session_state['processed_link'] = ""
-                st.rerun()
             else:
-                st.error(status)
+                st.session_state.status_message = ("error", status)
+
+    st.button("Add Chunks to Knowledge Library", on_click=add_processed_chunks)
 
 # # --- 4. Analyze Library and Select Metrics for Extraction ---
 # st.markdown("---")
@@ -289,33 +364,93 @@ if vector_store:
     else:
         st.info(f"The table will be generated by extracting the outcome: **'{user_outcome}'** from all documents in the library.")
         
-        if st.button("Generate Summary Table"):
+        # Disabled while a table job runs, so a second click can't orphan the first one
+        if st.button("Generate Summary Table", disabled='summary_table_job' in st.session_state):
             # Clear any old table data before generating new one
             if 'summary_table_df' in st.session_state:
                 del st.session_state['summary_table_df']
             if 'summary_table_sources' in st.session_state:
                 del st.session_state['summary_table_sources']
             
-            with st.spinner("Analyzing all documents..."):
-                
-                
-                # Call the function
-                result = generate_outcome_table(user_outcome)
-                
-                # Handle return values safely
-                if isinstance(result, tuple):
-                    extracted_df, status = result
-                else:
-                    extracted_df = result
-                    status = "Generated"
+            # Reuse the table of the same outcome (ignoring case/punctuation) instead of re-running every LLM call
+            cached_df, outcome_key = find_similar_outcome_table(user_outcome, vector_store, doc_count)
+            if cached_df is not None:
+                st.session_state['summary_table_df'] = cached_df
+                st.session_state['user_outcome'] = user_outcome
+                st.success("Reused the table already generated for this outcome.")
+            else:
+                # Only submit here; the fragment below polls until the job is done.
+                # Finished rows land in partial_rows as they complete so they can be shown early.
+                partial_rows = {}
+                submit_background_job('summary_table_job', generate_outcome_table, user_outcome, vector_store,
+                                      on_row=partial_rows.__setitem__, sources=sources_in_library)
+                st.session_state['summary_table_partial_rows'] = partial_rows
+                st.session_state['summary_table_outcome'] = user_outcome
+                st.session_state['summary_table_outcome_key'] = outcome_key
+                st.session_state['summary_table_doc_count'] = doc_count
+
+        def show_summary_table_job():
+            try:
+                result = poll_background_job('summary_table_job')
+            except Exception as e:
+                forget_summary_table_job()
+                st.session_state.status_message = ("error", f"Table generation failed: {e}")
+                st.rerun()
+            if result is None:
+                # Still running: one row per document, filled in as its extraction finishes
+                partial_rows = st.session_state.get('summary_table_partial_rows', {})
+                for source_url in sources_in_library:
+                    if CT_GOV_DOMAIN in source_url:
+                        continue
+                    c = st.columns([2, 2, 2, 1, 1, 1])
+                    c[0].markdown(f"[Link]({source_url})")
+                    row = partial_rows.get(source_url)
+                    if row is None:
+                        c[1].caption("Extracting...")
+                        continue
+                    c[1].text(row.get('Placebo Data', 'N/A'))
+                    c[2].text(row.get('Treatment Arms', 'N/A'))
+                    c[3].text(row.get('Durations', 'N/A'))
+                return
+
+            # Handle return values safely
+            if isinstance(result, tuple):
+                extracted_df, status = result
+            else:
+                extracted_df = result
+                status = "Generated"
             
-            st.success(status)
+            st.session_state.status_message = ("success", status)
             if extracted_df is not None:
                 st.session_state['summary_table_df'] = extracted_df
-                st.session_state['user_outcome'] = user_outcome
+                st.session_state['user_outcome'] = st.session_state['summary_table_outcome']
+                remember_outcome_table(st.session_state['summary_table_outcome_key'], extracted_df, vector_store,
+                                       st.session_state['summary_table_doc_count'])
+            forget_summary_table_job()
+            st.rerun()  # Full rerun so the finished table renders below
+
+        if 'summary_table_job' in st.session_state:
+            st.fragment(run_every=1.0)(show_summary_table_job)()
         
-        # Display table with manual columns
-        if 'summary_table_df' in st.session_state:
+        def refresh_summary_row(idx, source_url):
+            with st.spinner("Refreshing..."):
+                if CT_GOV_DOMAIN not in source_url:
+                    # --- CHANGE 5: Unpack only 2 values ---
+                    raw_block, _ = extract_outcome_from_doc(source_url, st.session_state['user_outcome'])
+                    
+                    if "N/A" not in raw_block:
+                        analysis = analyze_outcome_data(raw_block, st.session_state['user_outcome'])
+                        st.session_state['summary_table_df'].at[idx, 'Placebo Data'] = analysis.get("placebo_data", "N/A")
+                        st.session_state['summary_table_df'].at[idx, 'Treatment Arms'] = analysis.get("treatment_arms", "N/A")
+                        st.session_state['summary_table_df'].at[idx, 'Durations'] = analysis.get("durations", "N/A")
+                        st.session_state['summary_table_df'].at[idx, 'Raw Data Scoop'] = raw_block
+                        # Remove the definition update line
+
+        # A fragment, so refreshing a row reruns only the table
+        @st.fragment
+        def render_summary_table():
+            if 'summary_table_df' not in st.session_state:
+                return
             df = st.session_state['summary_table_df']
             
             # --- CHANGE 4: Update Columns (Remove one '2') ---
@@ -358,27 +493,13 @@ if vector_store:
                 
                 # 7. Refresh Button (Shifted to index 5)
                 with c[5]:
-                    if st.button("🔄", key=f"refresh_{idx}"):
-                        with st.spinner("Refreshing..."):
-                            from query_handler import extract_outcome_from_doc, analyze_outcome_data
-                            source_url = row['Source Document']
-                            
-                            if "clinicaltrials.gov" not in source_url:
-                                # --- CHANGE 5: Unpack only 2 values ---
-                                raw_block, _ = extract_outcome_from_doc(source_url, st.session_state['user_outcome'])
-                                
-                                if "N/A" not in raw_block:
-                                    analysis = analyze_outcome_data(raw_block, st.session_state['user_outcome'])
-                                    st.session_state['summary_table_df'].at[idx, 'Placebo Data'] = analysis.get("placebo_data", "N/A")
-                                    st.session_state['summary_table_df'].at[idx, 'Treatment Arms'] = analysis.get("treatment_arms", "N/A")
-                                    st.session_state['summary_table_df'].at[idx, 'Durations'] = analysis.get("durations", "N/A")
-                                    st.session_state['summary_table_df'].at[idx, 'Raw Data Scoop'] = raw_block
-                                    # Remove the definition update line
-                            
-                            st.rerun()
+                    # on_click updates the row before the fragment reruns
+                    st.button("🔄", key=f"refresh_{idx}", on_click=refresh_summary_row, args=(idx, row['Source Document']))
             
             st.divider()
 
+        render_summary_table()
+
 else:
     st.info("You must add documents to the Knowledge Library before you can generate a table.")
 
@@ -390,44 +511,38 @@ st.header("5. Test ClinicalTrials.gov Table Title Lister")
 vector_store_exists = st.session_state.get('vector_store') is not None
 
 if vector_store_exists:
-    vector_store = st.session_state.get('vector_store')
-    all_docs_metadata = vector_store.get(include=["metadatas"])
-    ct_sources = sorted(list(set(
-        meta['source'] for meta in all_docs_metadata['metadatas'] 
-        if "clinicaltrials.gov" in meta['source']
-    )))
-    
     if ct_sources:
         st.info("This will call the CT.gov API and list all data table titles found in the results section.")
-        doc_to_list = st.selectbox(
-            "Select a ClinicalTrials.gov document to list its tables:", 
-            options=ct_sources,
-            key="ct_gov_title_lister_test"
-        )
+        # A fragment, so picking a document or listing its tables reruns only this section
+        @st.fragment
+        def ct_gov_title_lister():
+            doc_to_list = st.selectbox(
+                "Select a ClinicalTrials.gov document to list its tables:", 
+                options=ct_sources,
+                key="ct_gov_title_lister_test"
+            )
         
-        if st.button("List Table Titles"):
-            if doc_to_list:
-                with st.spinner(f"Calling CT.gov API for {doc_to_list} and finding table titles..."):
-                    from data_ingestor import get_ct_gov_table_titles_from_api
-                    import re
-
-                    nct_match = re.search(r'NCT\d+', doc_to_list)
-                    if nct_match:
-                        nct_id = nct_match.group(0)
-                        table_titles, status = get_ct_gov_table_titles_from_api(nct_id)
+            if st.button("List Table Titles"):
+                if doc_to_list:
+                    with st.spinner(f"Calling CT.gov API for {doc_to_list} and finding table titles..."):
+                        nct_id = extract_nct_id(doc_to_list)
+                        if nct_id:
+                            table_titles, status = get_ct_gov_table_titles_from_api(nct_id)
                         
-                        st.info(status)
-                        if table_titles:
-                            st.write("Found the following table titles:")
-                            # Display as a numbered list
-                            for i, title in enumerate(table_titles):
-                                st.text(f"{i+1}. {title}")
-                        elif table_titles is not None: # Handles empty list case
-                            st.warning("No table titles were found in the results section of this trial.")
-                    else:
-                        st.error("Could not extract NCT ID from the selected URL.")
-            else:
-                st.warning("Please select a document to test.")
+                            st.info(status)
+                            if table_titles:
+                                st.write("Found the following table titles:")
+                                # Display as a numbered list
+                                for i, title in enumerate(table_titles):
+                                    st.text(f"{i+1}. {title}")
+                            elif table_titles is not None: # Handles empty list case
+                                st.warning("No table titles were found in the results section of this trial.")
+                        else:
+                            st.error("Could not extract NCT ID from the selected URL.")
+                else:
+                    st.warning("Please select a document to test.")
+
+        ct_gov_title_lister()
     else:
         st.info("No ClinicalTrials.gov documents are in the library to test.")
 else:
@@ -446,68 +561,57 @@ if st.session_state.get('vector_store'):
     if not user_outcome:
         st.warning("To test the locator, please perform a search on the main page with an 'Outcome of Interest' defined.")
     else:
-        vector_store = st.session_state.get('vector_store')
-        all_docs_metadata = vector_store.get(include=["metadatas"])
-        ct_sources = sorted(list(set(
-            meta['source'] for meta in all_docs_metadata['metadatas'] 
-            if "clinicaltrials.gov" in meta['source']
-        )))
-        
         if ct_sources:
             st.info(f"This will first get all table titles for a document, then use an LLM to select the ones relevant to: **'{user_outcome}'**")
-            doc_to_locate = st.selectbox(
-                "Select a ClinicalTrials.gov document to test the locator on:", 
-                options=ct_sources,
-                key="ct_gov_locator_test"
-            )
+            @st.fragment
+            def ct_gov_title_locator():
+                doc_to_locate = st.selectbox(
+                    "Select a ClinicalTrials.gov document to test the locator on:", 
+                    options=ct_sources,
+                    key="ct_gov_locator_test"
+                )
             
-            if st.button("Find Relevant Titles"):
-                if doc_to_locate:
-                    with st.spinner(f"Step 1: Getting all titles from {doc_to_locate}..."):
-                        from data_ingestor import get_ct_gov_table_titles_from_api
-                        import re
-                        nct_match = re.search(r'NCT\d+', doc_to_locate)
-                        if not nct_match:
-                            st.error("Could not extract NCT ID.")
-                        else:
-                            nct_id = nct_match.group(0)
-                            all_titles, status = get_ct_gov_table_titles_from_api(nct_id)
+                if st.button("Find Relevant Titles"):
+                    if doc_to_locate:
+                        with st.spinner(f"Step 1: Getting all titles from {doc_to_locate}..."):
+                            nct_id = extract_nct_id(doc_to_locate)
+                            if not nct_id:
+                                st.error("Could not extract NCT ID.")
+                            else:
+                                all_titles, status = get_ct_gov_table_titles_from_api(nct_id)
                     
-                    if all_titles:
-                        st.write("Found all titles. Now running Step 2: LLM Selection...")
-                        with st.spinner("Asking LLM to find relevant titles..."):
-                            from query_handler import find_relevant_table_titles
-                            
-                            relevant_titles, status = find_relevant_table_titles(all_titles, user_outcome)
+                        if all_titles:
+                            st.write("Found all titles. Now running Step 2: LLM Selection...")
+                            with st.spinner("Asking LLM to find relevant titles..."):
+                                relevant_titles, status = find_relevant_table_titles(all_titles, user_outcome)
                         
-                        st.info(status)
-                        if relevant_titles:
-                            st.write("LLM identified the following relevant titles:")
-                            st.dataframe(relevant_titles)
-                            # --- NEW: Run Extraction on these titles ---
-                            st.markdown("---")
-                            st.info("Step 3: Extracting Data for Selected Titles...")
+                            st.info(status)
+                            if relevant_titles:
+                                st.write("LLM identified the following relevant titles:")
+                                st.dataframe(relevant_titles)
+                                # --- NEW: Run Extraction on these titles ---
+                                st.markdown("---")
+                                st.info("Step 3: Extracting Data for Selected Titles...")
                             
-                            # Import our new function
-                            from data_ingestor import extract_data_for_selected_titles
+                                # Call the function with the NCT ID and the list of titles found by the LLM
+                                extracted_data, ext_status = extract_data_for_selected_titles(nct_id, relevant_titles)
                             
-                            # Call the function with the NCT ID and the list of titles found by the LLM
-                            extracted_data, ext_status = extract_data_for_selected_titles(nct_id, relevant_titles)
-                            
-                            if extracted_data:
-                                st.success("Data Extraction Successful!")
-                                # Display the results in a nice table
-                                st.table([
-                                    {"Metric/Table Name": k, "Extracted Values": v} 
-                                    for k, v in extracted_data.items()
-                                ])
+                                if extracted_data:
+                                    st.success("Data Extraction Successful!")
+                                    # Display the results in a nice table
+                                    st.table([
+                                        {"Metric/Table Name": k, "Extracted Values": v} 
+                                        for k, v in extracted_data.items()
+                                    ])
+                                else:
+                                    st.error(f"Extraction failed: {ext_status}")
+                                # --- END NEW ---
                             else:
-                                st.error(f"Extraction failed: {ext_status}")
-                            # --- END NEW ---
-                        else:
-                            st.warning("LLM did not identify any relevant titles from the list.")
-                else:
-                    st.warning("Please select a document to test.")
+                                st.warning("LLM did not identify any relevant titles from the list.")
+                    else:
+                        st.warning("Please select a document to test.")
+
+            ct_gov_title_locator()
         else:
             st.info("No ClinicalTrials.gov documents are in the library to test.")
 else:
@@ -522,9 +626,7 @@ if vector_store:
     
     if st.button("Generate CT.gov Table"):
         with st.spinner("Querying API for all CT.gov links..."):
-            from query_handler import generate_ct_gov_table
-            
-            ct_df, status = generate_ct_gov_table(user_outcome)
+            ct_df, status = generate_ct_gov_table(user_outcome, ct_sources=ct_sources)
             
             if ct_df is not None and not ct_df.empty:
                 st.success(status)
@@ -532,7 +634,24 @@ if vector_store:
             else:
                 st.warning(status)
 
-    if 'ct_gov_table_df' in st.session_state:
+    def refresh_ct_gov_row(idx, source_url):
+        with st.spinner("Refreshing..."):
+            nct_id = extract_nct_id(source_url)
+            
+            if nct_id:
+                # Unpack 4 values
+                p_val, t_val, tab_name, dur_val = process_single_ct_gov_doc(nct_id, user_outcome)
+                
+                st.session_state['ct_gov_table_df'].at[idx, 'Placebo/Control Value'] = p_val
+                st.session_state['ct_gov_table_df'].at[idx, 'Treatment Value'] = t_val
+                st.session_state['ct_gov_table_df'].at[idx, 'Table Name'] = tab_name
+                st.session_state['ct_gov_table_df'].at[idx, 'Duration'] = dur_val
+
+    # Same fragment pattern as the Section 4 table
+    @st.fragment
+    def render_ct_gov_table():
+        if 'ct_gov_table_df' not in st.session_state:
+            return
         df = st.session_state['ct_gov_table_df']
         
         # Updated Columns: Link(2), Table(3), Placebo(2), Treatment(2), Duration(2), Refresh(1)
@@ -556,23 +675,7 @@ if vector_store:
             c[4].text(row.get('Duration', 'N/A')) # New Data
             
             with c[5]:
-                if st.button("🔄", key=f"refresh_ct_{idx}"):
-                    with st.spinner("Refreshing..."):
-                        from query_handler import process_single_ct_gov_doc
-                        import re
-                        
-                        source_url = row['Link']
-                        nct_match = re.search(r'NCT\d+', source_url)
-                        
-                        if nct_match:
-                            nct_id = nct_match.group(0)
-                            # Unpack 4 values
-                            p_val, t_val, tab_name, dur_val = process_single_ct_gov_doc(nct_id, user_outcome)
-                            
-                            st.session_state['ct_gov_table_df'].at[idx, 'Placebo/Control Value'] = p_val
-                            st.session_state['ct_gov_table_df'].at[idx, 'Treatment Value'] = t_val
-                            st.session_state['ct_gov_table_df'].at[idx, 'Table Name'] = tab_name
-                            st.session_state['ct_gov_table_df'].at[idx, 'Duration'] = dur_val
-                            
-                            st.rerun()
+                st.button("🔄", key=f"refresh_ct_{idx}", on_click=refresh_ct_gov_row, args=(idx, row['Link']))
         st.divider()
+
+    render_ct_gov_table()
@@ -2,14 +2,76 @@
 
 import streamlit as st
 import json
+import re
+from difflib import SequenceMatcher
 from langchain_openai import ChatOpenAI
+from langchain_core.rate_limiters import InMemoryRateLimiter
+from langchain_core.caches import InMemoryCache
+import threading
+from collections import defaultdict
+from itertools import chain, zip_longest
 #from langchain.chains.retrieval_qa.base import RetrievalQA
 import pandas as pd
-
-def clean_json_output(text):
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from vector_store_manager import get_embedding_model, get_library_source_set
+from data_ingestor import extract_nct_id, get_ct_gov_table_titles_from_api, extract_data_for_selected_titles, CT_GOV_DOMAIN
+
+# Max number of documents processed concurrently by the library-wide controllers.
+# Each document is a chain of OpenRouter calls, so this bounds in-flight requests.
+MAX_PARALLEL_DOCS = 10
+
+# Token bucket shared by every session and both LLM instances (_llm_rate_limiter is a
+# cache_resource), so parallel table jobs queue here instead of tripping OpenRouter's rate limits with 429 storms.
+LLM_REQUESTS_PER_SECOND = 5
+
+# Responses kept per process for metric discovery and normalization (get_llm(cached=True)).
+# The model runs at temperature 0, so re-scanning an unchanged library repeats the same
+# prompts and can skip the API call. Table extraction and refreshes stay uncached: a
+# refresh or retry exists to get a different reply, and a bad reply must not stick.
+LLM_CACHE_SIZE = 2000
+
+class _ThreadSafeLLMCache(InMemoryCache):
+    """InMemoryCache evicts from a plain dict; library scans write to it from several threads."""
+    def __init__(self, maxsize=None):
+        super().__init__(maxsize=maxsize)
+        self._lock = threading.Lock()
+
+    def update(self, prompt, llm_string, return_val):
+        with self._lock:
+            super().update(prompt, llm_string, return_val)
+
+# Compiled once; used by the fallback parsers when an LLM reply isn't the expected format.
+# The runs around the number are bounded: unbounded, a long stretch of text without
+# digits makes the lazy prefix backtrack quadratically (seconds on a 20 KB chunk).
+METRIC_CANDIDATE_PATTERN = re.compile(r'([A-Za-z][\w\s/%\(\)\-]{0,80}?\d+[\w\s/%\(\)\-]{0,80})')
+NUMBER_PATTERN = re.compile(r'\b(\d+)\b')
+
+# Input budget for one discovery prompt (estimated at ~4 characters per token).
+# Papers that fit are sent whole; longer ones keep their most number-dense chunks.
+DISCOVERY_CONTEXT_TOKENS = 24000
+
+# Input budget for the scooper's merged retrieval (two k=40 searches of ~1500-char chunks).
+EXTRACTOR_CONTEXT_TOKENS = 12000
+
+# Outcomes that are the same words (ignoring case and punctuation) reuse a previously
+# generated table. Exact rather than by embedding similarity: near-synonyms such as
+# "systolic BP" and "diastolic BP" embed almost identically but are different outcomes.
+OUTCOME_WORD_PATTERN = re.compile(r'[a-z0-9]+')
+
+# Most CT.gov table titles sent to the LLM, ranked by embedding similarity to the outcome.
+# Similarity only orders the list: MiniLM scores different outcomes with near-identical
+# names (systolic vs diastolic BP) almost the same, so it never picks a title by itself.
+TITLE_SHORTLIST_SIZE = 15
+
+JSON_DECODER = json.JSONDecoder()
+
+def clean_json_output(text, expected_key=None):
     """
-    Robustly extracts JSON from LLM output by finding the first '{' and last '}'.
-    Handles Markdown blocks and conversational filler.
+    Robustly extracts JSON from LLM output.
+    Returns the first complete JSON object in the text (containing `expected_key`,
+    if given), so filler, Markdown blocks, or a second object around it don't break
+    parsing. Falls back to the span from the first '{' to the last '}'.
     """
     text = text.strip()
     
@@ -17,30 +79,56 @@ def clean_json_output(text):
     start_index = text.find('{')
     if start_index == -1:
         return text # No JSON object found, return original text (will likely fail parsing)
+
+    # 2. Try each '{' in turn; raw_decode stops at the end of that object
+    while start_index != -1:
+        try:
+            candidate, end_index = JSON_DECODER.raw_decode(text, start_index)
+            if isinstance(candidate, dict) and (expected_key is None or expected_key in candidate):
+                return text[start_index:end_index]
+        except ValueError:
+            pass
+        start_index = text.find('{', start_index + 1)
         
-    # 2. Find the end of the JSON object
+    # 3. Fall back to the outermost braces
+    start_index = text.find('{')
     end_index = text.rfind('}')
     if end_index == -1:
         return text # Incomplete JSON
         
-    # 3. Extract just the JSON part
     # Add 1 to end_index to include the closing brace
     return text[start_index : end_index + 1]
     
 @st.cache_resource
-def get_llm():
-    """Initializes the LLM for question answering, configured for OpenRouter."""
-    if "OPENROUTER_API_KEY" not in st.secrets:
+def _llm_rate_limiter():
+    """One token bucket for every LLM instance, cached or not."""
+    return InMemoryRateLimiter(
+        requests_per_second=LLM_REQUESTS_PER_SECOND,
+        check_every_n_seconds=0.1,
+        max_bucket_size=LLM_REQUESTS_PER_SECOND * 2,
+    )
+
+@st.cache_resource
+def get_llm(cached=False):
+    """
+    Initializes the LLM for question answering, configured for OpenRouter.
+    `cached=True` returns a separate instance that reuses replies to repeated prompts;
+    only use it where a stored reply is as good as a fresh one (library metric scans).
+    """
+    api_key = st.secrets.get("OPENROUTER_API_KEY")
+    if not api_key:
         st.error("Openrouter_API_key not found in Streamlit secrets. Please add it.")
         return None
     try:
         # Use a model known for strong instruction-following and JSON capabilities
         llm = ChatOpenAI(
             model_name="meta-llama/llama-3.3-70b-instruct",#"google/gemini-2.0-flash-exp",#"meta-llama/llama-3.2-3b-instruct",#"meta-llama/llama-3-8b-instruct", #"amazon/nova-2-lite-v1",#"google/gemini-2.0-flash-exp:free",# "microsoft/Phi-3-mini-128k-instruct",#"meta-llama/llama-3-8b-instruct",
-            openai_api_key=st.secrets.get("OPENROUTER_API_KEY"),
+            openai_api_key=api_key,
             openai_api_base="https://openrouter.ai/api/v1",
             temperature=0.0, # Crucial for factual, non-creative extraction
             max_tokens=4096,
+            rate_limiter=_llm_rate_limiter(),
+            cache=_ThreadSafeLLMCache(maxsize=LLM_CACHE_SIZE) if cached else False,
             # model_kwargs={
             #     "response_format": {"type": "json_object"} # Instruct the model to output JSON
             # }
@@ -60,27 +148,63 @@ def get_llm():
 # In query_handler.py
 # REPLACE the entire discover_metrics_in_doc function with this new version
 
-def discover_metrics_in_doc(source_url):
+def _fit_to_budget(docs, max_tokens):
+    """
+    Keeps retrieved docs in rank order while they fit the estimated token budget
+    (~4 characters per token). A doc too large for what's left is skipped rather than
+    ending the selection, so one oversized chunk can't leave the context empty.
+    """
+    kept, used = [], 0
+    for doc in docs:
+        cost = len(doc.page_content) // 4 + 1
+        if used + cost > max_tokens:
+            continue
+        kept.append(doc)
+        used += cost
+    return kept
+
+def _select_discovery_context(chunks, max_tokens=DISCOVERY_CONTEXT_TOKENS):
+    """
+    Returns the chunks to send for metric discovery: all of them when the document
+    fits the budget, otherwise the chunks with the most number-bearing phrases
+    (where results are reported), kept in document order.
+    """
+    if sum(len(chunk) for chunk in chunks) // 4 <= max_tokens:
+        return chunks
+    ranked = sorted(range(len(chunks)), key=lambda i: len(METRIC_CANDIDATE_PATTERN.findall(chunks[i])), reverse=True)
+    kept, used = set(), 0
+    for i in ranked:
+        cost = len(chunks[i]) // 4 + 1
+        if used + cost <= max_tokens:
+            kept.add(i)
+            used += cost
+    return [chunks[i] for i in sorted(kept)]
+
+def discover_metrics_in_doc(source_url, vector_store=None, context_chunks=None, llm=None):
     """
     Performs a RAG query on a single document to find all quantifiable metrics.
     Retrieves ALL chunks for full context, and guarantees the return is a list of strings.
+    Library scans pass the document's chunks as `context_chunks` to skip the per-document
+    query, and their `llm` so each document doesn't fetch it again.
     """
-    import re
-
-    vector_store = st.session_state.get('vector_store', None)
+    if vector_store is None:
+        vector_store = st.session_state.get('vector_store', None)
     if not vector_store:
         return None, "Vector Store not found in session."
 
-    llm = get_llm()
+    if llm is None:
+        llm = get_llm(cached=True)
     if not llm:
         return None, "LLM not initialized."
 
     # --- Retrieve ALL chunks for the document ---
-    all_doc_chunks = vector_store.get(
-        where={"source": source_url},
-        include=["documents"]
-    )
-    context_string = "\n\n---\n\n".join(all_doc_chunks.get("documents", []))
+    if context_chunks is None:
+        all_doc_chunks = vector_store.get(
+            where={"source": source_url},
+            include=["documents"]
+        )
+        context_chunks = all_doc_chunks.get("documents", [])
+    context_string = "\n\n---\n\n".join(_select_discovery_context(context_chunks))
 
     if not context_string.strip():
         return [], "No text content found for this document in the vector store."
@@ -120,11 +244,12 @@ def discover_metrics_in_doc(source_url):
         result = llm.invoke(discovery_prompt)
         raw_output = getattr(result, "content", str(result))
 
-        st.write("🔎 Raw LLM Output:", raw_output)
+        # # --- DEBUGGING OUTPUT ---
+        # st.write("🔎 Raw LLM Output:", raw_output)
 
         # Try JSON first
         try:
-            answer_json = json.loads(raw_output)
+            answer_json = json.loads(clean_json_output(raw_output, "metrics"))
             metrics_list = _force_strings(answer_json.get("metrics", []))
             if metrics_list:
                 return metrics_list, "Discovery successful."
@@ -132,7 +257,7 @@ def discover_metrics_in_doc(source_url):
             st.warning("⚠️ JSON parsing failed, using fallback parsing.")
 
         # --- Fallback: regex-based extraction ---
-        candidates = re.findall(r'([A-Za-z][\w\s/%\(\)\-]*?\d+[\w\s/%\(\)\-]*)', raw_output)
+        candidates = METRIC_CANDIDATE_PATTERN.findall(raw_output)
         fallback_metrics = _force_strings(candidates)
 
         if fallback_metrics:
@@ -150,7 +275,7 @@ def _normalize_metrics(raw_metrics_list, llm):
     Uses an LLM to normalize a messy list of metric names.
     """
     # Get unique, non-empty metric names
-    unique_metrics = sorted(list(set(m for m in raw_metrics_list if m)))
+    unique_metrics = sorted({m for m in raw_metrics_list if m})
     
     if not unique_metrics:
         return {}
@@ -173,7 +298,7 @@ def _normalize_metrics(raw_metrics_list, llm):
         # Note: Using .invoke() directly on the string with ChatOpenAI
         result = llm.invoke(normalization_prompt)
         # The response from ChatOpenAI is an AIMessage object, its content is in the .content attribute
-        normalized_map = json.loads(result.content)
+        normalized_map = json.loads(clean_json_output(result.content))
         return normalized_map
     except (json.JSONDecodeError, TypeError) as e:
         st.error(f"Failed to parse LLM response during normalization: {e}")
@@ -183,38 +308,60 @@ def _normalize_metrics(raw_metrics_list, llm):
         st.error(f"An error occurred during normalization: {e}")
         return None
 
-def discover_and_normalize_metrics_from_library():
+def discover_and_normalize_metrics_from_library(vector_store=None, on_progress=None, max_concurrent=MAX_PARALLEL_DOCS):
     """
     Scans all documents in the vector store, discovers all metrics,
     normalizes them, and returns a counted & sorted list of common metrics.
+    Runs on the script thread: it writes a spinner, the per-document report and
+    normalization errors with st.*. `vector_store` and `on_progress` let the caller
+    supply the store and its own progress display.
+    `max_concurrent` bounds how many documents are queried at once (tune for rate limits).
     """
-    vector_store = st.session_state.get('vector_store', None)
+    if vector_store is None:
+        vector_store = st.session_state.get('vector_store', None)
     if not vector_store:
         return None, "Vector Store is not available."
 
-    llm = get_llm()
+    llm = get_llm(cached=True)
     if not llm:
         return None, "LLM is not available."
 
-    all_docs_metadata = vector_store.get(include=["metadatas"])
-    unique_sources = sorted(list(set(meta['source'] for meta in all_docs_metadata['metadatas'])))
+    # One read of the whole library, grouped by source, instead of a query per document
+    all_docs = vector_store.get(include=["metadatas", "documents"])
+    chunks_by_source = defaultdict(list)
+    for meta, text in zip(all_docs['metadatas'], all_docs['documents']):
+        chunks_by_source[meta['source']].append(text)
+    unique_sources = sorted(chunks_by_source)
     
     if not unique_sources:
         return None, "No documents found in the library to analyze."
 
     # --- Phase 1: Discovery ---
     raw_metrics_per_doc = {}
-    progress_bar = st.progress(0, text="Starting discovery phase...")
+    progress_bar = None if on_progress else st.progress(0, text="Starting discovery phase...")
+    report_progress = on_progress or progress_bar.progress
     
-    for i, source_url in enumerate(unique_sources):
-        progress_bar.progress((i + 1) / len(unique_sources), text=f"Discovering metrics in: {source_url}")
-        metrics_list, status = discover_metrics_in_doc(source_url)
+    # Per-document discovery is independent and network-bound, so run it over a
+    # bounded pool; results are collected back in source order.
+    metrics_per_source = [None] * len(unique_sources)
+    with ThreadPoolExecutor(max_workers=max_concurrent) as executor:
+        futures = {
+            executor.submit(discover_metrics_in_doc, source_url, vector_store, chunks_by_source[source_url], llm): i
+            for i, source_url in enumerate(unique_sources)
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            i = futures[future]
+            metrics_per_source[i], _ = future.result()
+            report_progress(done / len(unique_sources), text=f"Discovering metrics in: {unique_sources[i]}")
+
+    for source_url, metrics_list in zip(unique_sources, metrics_per_source):
         if metrics_list:
             raw_metrics_per_doc[source_url] = metrics_list
     
-    progress_bar.empty()
+    if progress_bar:
+        progress_bar.empty()
     
-    all_raw_metrics = [metric for metrics in raw_metrics_per_doc.values() for metric in metrics]
+    all_raw_metrics = list(chain.from_iterable(raw_metrics_per_doc.values()))
     if not all_raw_metrics:
         return pd.DataFrame(), "Discovery complete. No quantifiable metrics were found across any documents."
 
@@ -232,55 +379,56 @@ def discover_and_normalize_metrics_from_library():
         for synonym in synonyms
     }
     
-    for doc, raw_metrics in raw_metrics_per_doc.items():
-        if not raw_metrics:
-            st.write(f"📄 {doc}: No metrics discovered.")
-            continue
-        normalized = []
-        for metric in raw_metrics:
-            norm = synonym_to_canonical_map.get(metric.lower(), metric)
-            normalized.append(norm)
-        st.write(f"📄 {doc}")
-        st.write("   Raw metrics:", raw_metrics)
-        st.write("   Normalized metrics:", normalized)
+    # One table for all documents instead of three writes per document
+    st.dataframe(pd.DataFrame([
+        {
+            "Document": doc,
+            "Raw metrics": ", ".join(raw_metrics) or "No metrics discovered.",
+            "Normalized metrics": ", ".join(synonym_to_canonical_map.get(metric.lower(), metric) for metric in raw_metrics),
+        }
+        for doc, raw_metrics in raw_metrics_per_doc.items()
+    ]))
 
     # --- Phase 3: Counting and Formatting ---
-    # Invert the map for easy lookup
-    synonym_to_canonical_map = {synonym.lower(): canonical for canonical, synonyms in normalized_map.items() for synonym in synonyms}
-    
-    # Count occurrences of each CANONICAL metric across documents
-    canonical_counts = {}
-    for source_metrics in raw_metrics_per_doc.values():
-        canonical_metrics_in_doc = set()
-        for metric in source_metrics:
-            if metric.lower() in synonym_to_canonical_map:
-                canonical_metrics_in_doc.add(synonym_to_canonical_map[metric.lower()])
-        
-        for canonical_metric in canonical_metrics_in_doc:
-            canonical_counts[canonical_metric] = canonical_counts.get(canonical_metric, 0) + 1
+    # One row per discovered metric, so counting is a pandas group-by instead of nested loops
+    metrics_long = pd.DataFrame(
+        [(source, metric.lower()) for source, metrics in raw_metrics_per_doc.items() for metric in metrics],
+        columns=["source", "metric"]
+    )
+    metrics_long["canonical"] = metrics_long["metric"].map(synonym_to_canonical_map)
+    
+    # Count each CANONICAL metric once per document it appears in
+    canonical_counts = (
+        metrics_long.dropna(subset=["canonical"])
+        .drop_duplicates(["source", "canonical"])["canonical"]
+        .value_counts()
+    )
             
-    if not canonical_counts:
+    if canonical_counts.empty:
         return pd.DataFrame(), "Could not count any canonical metrics."
 
     # Create a DataFrame for display
     metrics_df = pd.DataFrame({
-        "Metric Name": canonical_counts.keys(),
-        "Found in # Docs": canonical_counts.values()
+        "Metric Name": canonical_counts.index,
+        "Found in # Docs": canonical_counts.values
     })
     metrics_df["Prevalence (%)"] = (metrics_df["Found in # Docs"] / len(unique_sources)) * 100
     metrics_df = metrics_df.sort_values(by="Found in # Docs", ascending=False).reset_index(drop=True)
     
     return metrics_df, "Metric discovery and normalization complete."
 
-def extract_outcome_from_doc(source_url, user_outcome_of_interest):
+def extract_outcome_from_doc(source_url, user_outcome_of_interest, vector_store=None, llm=None):
     """
     Performs a targeted RAG query to "scoop" all raw data related to an outcome.
     Step 1: Locator (Find name + definition).
     Step 2: Scooper (Extract all relevant text/table rows).
+    Table generation passes its `llm` so each document doesn't fetch it again.
     """
-    vector_store = st.session_state.get('vector_store', None)
+    if vector_store is None:
+        vector_store = st.session_state.get('vector_store', None)
     if not vector_store: return None, "Vector Store not found.", "Error"
-    llm = get_llm()
+    if llm is None:
+        llm = get_llm()
     if not llm: return None, "LLM not initialized.", "Error"
 
     # --- Step 1: The "Locator" Query (Unchanged) ---
@@ -305,15 +453,6 @@ def extract_outcome_from_doc(source_url, user_outcome_of_interest):
     Respond in JSON with one key "exact_metric_name". If not found, return null.
     """
     
-    exact_metric_name = user_outcome_of_interest
-    try:
-        result = llm.invoke(locator_prompt)
-        cleaned_content = clean_json_output(result.content)
-        answer_json = json.loads(cleaned_content)
-        if answer_json.get("exact_metric_name"): exact_metric_name = answer_json.get("exact_metric_name")
-    except Exception:
-        pass
-    
     # --- Step 2: The "Scooper" Query (Modified) ---
     # extractor_retriever = vector_store.as_retriever(
     #     search_kwargs={'k': 20, 'filter': { # Increased k to capture more context/table rows
@@ -330,9 +469,23 @@ def extract_outcome_from_doc(source_url, user_outcome_of_interest):
     # extractor_query = f"{user_outcome_of_interest} {exact_metric_name} table data values"
     # context_chunks_for_extractor = extractor_retriever.invoke(extractor_query)
 
-    # --- CHANGE: Ensemble Retrieval (Merged Scoop) ---
-    # 1. Search using the User's Input (The "Anchor")
-    chunks_original = extractor_retriever.invoke(user_outcome_of_interest)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        # --- CHANGE: Ensemble Retrieval (Merged Scoop) ---
+        # 1. Search using the User's Input (The "Anchor"). It doesn't depend on the
+        # locator's answer, so it runs while the locator LLM call is in flight.
+        chunks_original_future = executor.submit(extractor_retriever.invoke, user_outcome_of_interest)
+
+        exact_metric_name = user_outcome_of_interest
+        try:
+            # A one-key JSON reply; the cap cuts off any trailing explanation
+            result = llm.bind(max_tokens=128).invoke(locator_prompt)
+            cleaned_content = clean_json_output(result.content, "exact_metric_name")
+            answer_json = json.loads(cleaned_content)
+            if answer_json.get("exact_metric_name"): exact_metric_name = answer_json.get("exact_metric_name")
+        except Exception:
+            pass
+
+        chunks_original = chunks_original_future.result()
     
     # 2. Search using the LLM's Found Name (The "Specific")
     chunks_specific = []
@@ -340,13 +493,15 @@ def extract_outcome_from_doc(source_url, user_outcome_of_interest):
         chunks_specific = extractor_retriever.invoke(exact_metric_name)
     
     # 3. Merge and Deduplicate based on text content
-    # Using a dict preserves order while removing duplicates
-    combined_chunks_map = {doc.page_content: doc for doc in chunks_original + chunks_specific}
-    context_chunks_for_extractor = list(combined_chunks_map.values())
+    # Interleaved by rank, so the budget below drops the weakest hits of both searches;
+    # using a dict preserves order while removing duplicates
+    ranked_chunks = [doc for pair in zip_longest(chunks_original, chunks_specific) for doc in pair if doc is not None]
+    combined_chunks_map = {doc.page_content: doc for doc in ranked_chunks}
+    context_chunks_for_extractor = _fit_to_budget(combined_chunks_map.values(), EXTRACTOR_CONTEXT_TOKENS)
     # -------------------------------------------------
     
     if not context_chunks_for_extractor:
-        return "N/A (No data found for this metric)", metric_definition, "Extraction complete."
+        return "N/A (No data found for this metric)", "Extraction complete."
 
     context_string_for_extractor = "\n\n---\n\n".join([doc.page_content for doc in context_chunks_for_extractor])
 
@@ -498,77 +653,153 @@ def extract_outcome_from_doc(source_url, user_outcome_of_interest):
 
 
 
-def generate_outcome_table(outcome_of_interest):
+def _extract_outcome_row(source_url, outcome_of_interest, vector_store, llm):
+    """
+    Builds one row of the outcome table for a single PubMed document.
+    """
+    # Default values
+    findings_str = "N/A"
+    placebo_data = "N/A"
+    treatment_arms = "N/A"
+    durations = "N/A"
+    raw_scoop = "N/A"
+    
+    # --- PUBMED WORKFLOW ---
+    # 1. Scoop the raw data
+    raw_data_block, status = extract_outcome_from_doc(source_url, outcome_of_interest, vector_store, llm)
+    
+    raw_scoop = raw_data_block # Store the raw text
+
+    # 2. Analyze the data (Step 2)
+    if raw_data_block and "N/A" not in raw_data_block and raw_data_block.strip():
+        analysis = analyze_outcome_data(raw_data_block, outcome_of_interest, llm)
+        placebo_data = analysis.get("placebo_data", "N/A")
+        treatment_arms = analysis.get("treatment_arms", "N/A")
+        durations = analysis.get("durations", "N/A")
+        
+        # For the main "Outcome" column, we can use the raw scoop or a summary. 
+        # For now, let's keep the raw scoop as the main finding, or leave it blank if you prefer the specific columns.
+        # Let's set findings_str to "See detailed columns" or similar if we have good analysis.
+        findings_str = "See extracted details" 
+    else:
+        findings_str = "Data not found"
+
+    return {
+        "Source Document": source_url,
+        f"Outcome: {outcome_of_interest}": findings_str,
+        "Placebo Data": placebo_data,
+        "Treatment Arms": treatment_arms,
+        "Durations": durations,
+        "Raw Data Scoop": raw_scoop
+    }
+
+def generate_outcome_table(outcome_of_interest, vector_store=None, on_progress=None, on_row=None, sources=None,
+                           max_concurrent=MAX_PARALLEL_DOCS):
     """
     Main controller to generate the final data table.
     Iterates through all unique documents in the vector store and extracts the
     specified outcome for each one.
+    Pass `vector_store` and `on_progress` when running off the script thread,
+    where st.session_state and st.progress are not available.
+    `on_row(source_url, row)` is called as each document's row completes, so
+    callers can show rows before the whole table is ready.
+    `sources` is the library's sorted source list, read from Chroma if omitted.
+    `max_concurrent` bounds how many documents are extracted at once (tune for rate limits).
     """
-    vector_store = st.session_state.get('vector_store', None)
+    if vector_store is None:
+        vector_store = st.session_state.get('vector_store', None)
     if not vector_store:
         return None, "Vector Store not found. Please add documents first."
 
-    all_docs_metadata = vector_store.get(include=["metadatas"])
-    unique_sources = sorted(list(set(meta['source'] for meta in all_docs_metadata['metadatas'])))
+    # Fetched once here and handed to every document's extraction
+    llm = get_llm()
+    if not llm:
+        return None, "LLM not initialized."
+
+    if sources is None:
+        all_docs_metadata = vector_store.get(include=["metadatas"])
+        sources = sorted({meta['source'] for meta in all_docs_metadata['metadatas']})
+    # CT.gov records have their own table (generate_ct_gov_table); dropping them here
+    # keeps them out of the worker pool and the progress count
+    unique_sources = [source_url for source_url in sources if CT_GOV_DOMAIN not in source_url]
     
     if not unique_sources:
         return None, "No documents found in the library to analyze."
 
-    table_data = []
-    progress_bar = st.progress(0, text="Starting table generation...")
-
-    for i, source_url in enumerate(unique_sources):
-        progress_bar.progress((i + 1) / len(unique_sources), text=f"Extracting from: {source_url}")
-
-        # Default values
-        findings_str = "N/A"
-        definition_str = "N/A"
-        placebo_data = "N/A"
-        treatment_arms = "N/A"
-        durations = "N/A"
-        raw_scoop = "N/A"
-                    
-        # --- NEW: Filter out ClinicalTrials.gov links ---
-        if "clinicaltrials.gov" in source_url:
-            continue
-        # --- END NEW ---
-        
-        # --- PUBMED WORKFLOW ---
-        # 1. Scoop the raw data
-        raw_data_block, status = extract_outcome_from_doc(source_url, outcome_of_interest)
-        
-        raw_scoop = raw_data_block # Store the raw text
-
-        # 2. Analyze the data (Step 2)
-        if raw_data_block and "N/A" not in raw_data_block and raw_data_block.strip():
-            analysis = analyze_outcome_data(raw_data_block, outcome_of_interest)
-            placebo_data = analysis.get("placebo_data", "N/A")
-            treatment_arms = analysis.get("treatment_arms", "N/A")
-            durations = analysis.get("durations", "N/A")
-            
-            # For the main "Outcome" column, we can use the raw scoop or a summary. 
-            # For now, let's keep the raw scoop as the main finding, or leave it blank if you prefer the specific columns.
-            # Let's set findings_str to "See detailed columns" or similar if we have good analysis.
-            findings_str = "See extracted details" 
-        else:
-            findings_str = "Data not found"
+    progress_bar = None if on_progress else st.progress(0, text="Starting table generation...")
+    report_progress = on_progress or progress_bar.progress
+
+    # Each document is an independent, network-bound chain of LLM calls, so fan
+    # them out over a bounded pool and collect rows back in source order.
+    rows = [None] * len(unique_sources)
+    with ThreadPoolExecutor(max_workers=max_concurrent) as executor:
+        futures = {
+            executor.submit(_extract_outcome_row, source_url, outcome_of_interest, vector_store, llm): i
+            for i, source_url in enumerate(unique_sources)
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            i = futures[future]
+            rows[i] = future.result()
+            if on_row:
+                on_row(unique_sources[i], rows[i])
+            report_progress(done / len(unique_sources), text=f"Extracted from: {unique_sources[i]}")
+
+    if progress_bar:
+        progress_bar.empty()
+
+    df = pd.DataFrame(rows)
+    return df, "Table generation complete."
 
-        table_data.append({
-            "Source Document": source_url,
-            f"Outcome: {outcome_of_interest}": findings_str,
-            "Placebo Data": placebo_data,
-            "Treatment Arms": treatment_arms,
-            "Durations": durations,
-            "Raw Data Scoop": raw_scoop
-        })
+    # In query_handler.py, add this new function at the end of the file
 
-    progress_bar.empty()
-    if not table_data: return None, "Could not extract data."
+# --- Outcome table cache for generate_outcome_table ---
+def _library_cache_key(vector_store, doc_count=None):
+    """Identifies the current library contents; cached tables are only valid for it."""
+    collection = vector_store._collection
+    return (collection.name, collection.count() if doc_count is None else doc_count)
 
-    df = pd.DataFrame(table_data)
-    return df, "Table generation complete."
+def _outcome_cache_key(outcome_of_interest):
+    """'Fasting Glucose (mg/dL)' and 'fasting glucose mg/dl' map to the same key."""
+    return " ".join(OUTCOME_WORD_PATTERN.findall(outcome_of_interest.lower()))
 
-    # In query_handler.py, add this new function at the end of the file
+def find_similar_outcome_table(outcome_of_interest, vector_store, doc_count=None):
+    """
+    Looks for a table already generated for the same outcome (differing only in case,
+    spacing or punctuation) against the same library.
+    Returns (cached_df or None, outcome_key). Pass the key on to
+    remember_outcome_table once a fresh table has been generated.
+    """
+    outcome_key = _outcome_cache_key(outcome_of_interest)
+    cache = st.session_state.get('outcome_cache')
+    if not cache or cache["library"] != _library_cache_key(vector_store, doc_count):
+        return None, outcome_key
+
+    cached_df = cache["tables"].get(outcome_key)
+    if cached_df is None:
+        return None, outcome_key
+    # Copy so in-place row refreshes don't leak back into the cache, and label the
+    # outcome column with the outcome as the user typed it this time
+    df = cached_df.copy()
+    outcome_column = next((column for column in df.columns if column.startswith("Outcome: ")), None)
+    if outcome_column:
+        df = df.rename(columns={outcome_column: f"Outcome: {outcome_of_interest}"})
+    return df, outcome_key
+
+def remember_outcome_table(outcome_key, df, vector_store, doc_count=None):
+    """
+    Adds a freshly generated table to the outcome table cache.
+    Pass the `doc_count` the table was generated against, so a document added
+    while the table was being generated doesn't get it cached for the new library.
+    """
+    if outcome_key is None or df is None:
+        return
+    library_key = _library_cache_key(vector_store, doc_count)
+    cache = st.session_state.get('outcome_cache')
+    if not cache or cache["library"] != library_key:
+        cache = {"library": library_key, "tables": {}}
+    cache["tables"][outcome_key] = df.copy()
+    st.session_state['outcome_cache'] = cache
+# --- END Outcome table cache ---
 
 # def find_relevant_table_titles(all_titles, user_outcome_of_interest):
 #     """
@@ -627,20 +858,51 @@ def generate_outcome_table(outcome_of_interest):
 #         return fallback_titles, "Used fallback keyword matching."
 
 
+def _shortlist_titles(titles, user_outcome_of_interest, size=TITLE_SHORTLIST_SIZE):
+    """
+    Returns the indices of the `size` titles most similar to the outcome, best first.
+    Short lists (or a failed embedding call) keep every title in its original order.
+    """
+    all_indices = list(range(len(titles)))
+    if len(titles) <= size:
+        return all_indices
+    embedding_model = get_embedding_model()
+    if not embedding_model:
+        return all_indices
+    # One batched call; repeated titles and outcomes come from the embedding cache
+    try:
+        embeddings = embedding_model.embed_documents([user_outcome_of_interest] + titles)
+    except ValueError as e:
+        st.warning(f"Similarity ranking unavailable, sending every title to the LLM: {e}")
+        return all_indices
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    # Rows are unit length, so one matrix-vector product gives every cosine similarity
+    similarities = matrix[1:] @ matrix[0]
+    return [int(i) for i in np.argsort(-similarities, kind="stable")[:size]]
+
 def find_relevant_table_titles(all_titles, user_outcome_of_interest):
     """
     Uses an LLM to select the most relevant title from a list based on the user's outcome.
     Enhanced with multiple strategies to force concise output.
+    A title that is the outcome itself (ignoring case and punctuation) is picked
+    without an LLM call; otherwise the LLM sees the titles most similar to it.
     """
+    # Remove prefixes for cleaner matching
+    titles_for_prompt = [title.split("] ", 1)[1] if "] " in title else title for title in all_titles]
+
+    outcome_key = _outcome_cache_key(user_outcome_of_interest)
+    for title, clean_title in zip(all_titles, titles_for_prompt):
+        if _outcome_cache_key(clean_title) == outcome_key:
+            st.success(f"✓ Exact title match: {title}")
+            return [title], "Identified relevant title by exact match."
+
     llm = get_llm()
     if not llm:
         return None, "LLM not initialized."
-
-    # Remove prefixes for cleaner matching
-    titles_for_prompt = [title.split("] ", 1)[1] if "] " in title else title for title in all_titles]
     
-    # Strategy 1: Numbered list for easier parsing
-    titles_string = "\n".join(f"{i+1}. {title}" for i, title in enumerate(titles_for_prompt))
+    # Strategy 1: Numbered list for easier parsing (prompt number n is all_titles[shortlist[n-1]])
+    shortlist = _shortlist_titles(titles_for_prompt, user_outcome_of_interest)
+    titles_string = "\n".join(f"{n}. {titles_for_prompt[i]}" for n, i in enumerate(shortlist, start=1))
 
     # Strategy 2: Extremely strict prompt with multiple constraints
     locator_prompt = f"""You must respond with ONLY numbers separated by commas.
@@ -661,7 +923,8 @@ Your response:"""
 
     try:
         # Strategy 3: Reduce max_tokens drastically to prevent long responses
-        response = llm.invoke(locator_prompt)
+        # (bound per call, so the shared LLM keeps its default limit)
+        response = llm.bind(max_tokens=16).invoke(locator_prompt)
         response_content = response.content.strip()
         
         # # --- DEBUGGING OUTPUT ---
@@ -675,7 +938,7 @@ Your response:"""
         try:
             # Split by comma and parse each number
             numbers = [int(n.strip()) for n in response_content.replace(' ', '').split(',')]
-            selected_indices = [n - 1 for n in numbers if 0 < n <= len(all_titles)]
+            selected_indices = [shortlist[n - 1] for n in numbers if 0 < n <= len(shortlist)]
             
             # Limit to top 4
             selected_indices = selected_indices[:1]  # <-- THIS IS THE [:4] YOU'RE LOOKING FOR
@@ -688,18 +951,16 @@ Your response:"""
             pass  # Try next method
         
         # Method B: Extract first number from response
-        import re
-        numbers = re.findall(r'\b(\d+)\b', response_content)
+        numbers = NUMBER_PATTERN.findall(response_content)
         if numbers:
-            selected_index = int(numbers[0]) - 1
-            if 0 <= selected_index < len(all_titles):
-                selected_title = all_titles[selected_index]
+            selected_number = int(numbers[0])
+            if 0 < selected_number <= len(shortlist):
+                selected_title = all_titles[shortlist[selected_number - 1]]
                 st.success(f"✓ Successfully matched to: {selected_title}")
                 return [selected_title], "Successfully identified relevant title."
         
         # Method C: Fuzzy string matching (fallback)
         st.warning("Could not parse number, attempting fuzzy matching...")
-        from difflib import SequenceMatcher
         
         best_match = None
         best_score = 0
@@ -742,12 +1003,13 @@ Your response:"""
         else:
             return [], "No matches found even with keyword fallback."
 
-def analyze_outcome_data(raw_data_block, outcome_name):
+def analyze_outcome_data(raw_data_block, outcome_name, llm=None):
     """
     Step 2: Analyzes the "scooped" raw data.
     Uses a "Retry Loop" to ensure high-quality extraction.
     """
-    llm = get_llm()
+    if llm is None:
+        llm = get_llm()
     if not llm: return None
 
     best_result = {
@@ -779,9 +1041,9 @@ def analyze_outcome_data(raw_data_block, outcome_name):
             }}
             """
             
-            # Run Classifier
-            result = llm.invoke(classification_prompt)
-            cleaned = clean_json_output(result.content)
+            # Run Classifier (group names only, so a short reply is enough)
+            result = llm.bind(max_tokens=512).invoke(classification_prompt)
+            cleaned = clean_json_output(result.content, "placebo_name")
             classification = json.loads(cleaned)
             
             placebo_name = classification.get("placebo_name", "None")
@@ -864,7 +1126,7 @@ def analyze_outcome_data(raw_data_block, outcome_name):
             # """
 
             result = llm.invoke(extraction_prompt)
-            cleaned_content = clean_json_output(result.content)
+            cleaned_content = clean_json_output(result.content, "placebo_data")
             current_analysis = json.loads(cleaned_content)
             
             # --- QUALITY CHECK ---
@@ -888,8 +1150,6 @@ def process_single_ct_gov_doc(nct_id, outcome_of_interest):
     Runs the full 3-step API workflow for a single CT.gov ID.
     Returns: (placebo_str, treatment_str, table_names_str, duration_str)
     """
-    from data_ingestor import get_ct_gov_table_titles_from_api, extract_data_for_selected_titles
-    
     all_titles, _ = get_ct_gov_table_titles_from_api(nct_id)
     if not all_titles: return "N/A", "N/A", "No data tables found", "N/A"
 
@@ -928,17 +1188,19 @@ def process_single_ct_gov_doc(nct_id, outcome_of_interest):
     treatment_cell = " || ".join(treatment_list) if treatment_list else "N/A"
     table_name_cell = " || ".join(table_names)
     # Deduplicate durations and join
-    duration_cell = " || ".join(sorted(list(set(durations)))) if durations else "N/A"
+    duration_cell = " || ".join(sorted(set(durations))) if durations else "N/A"
 
     return placebo_cell, treatment_cell, table_name_cell, duration_cell
 
-def generate_ct_gov_table(outcome_of_interest):
-    """Generates the table for ClinicalTrials.gov links."""
+def generate_ct_gov_table(outcome_of_interest, ct_sources=None):
+    """
+    Generates the table for ClinicalTrials.gov links (`ct_sources`, or the library's).
+    """
     vector_store = st.session_state.get('vector_store', None)
     if not vector_store: return None, "Vector Store not found."
 
-    all_docs_metadata = vector_store.get(include=["metadatas"])
-    ct_sources = sorted(list(set(meta['source'] for meta in all_docs_metadata['metadatas'] if "clinicaltrials.gov" in meta['source'])))
+    if ct_sources is None:
+        ct_sources = sorted(source for source in get_library_source_set(vector_store) if CT_GOV_DOMAIN in source)
     
     if not ct_sources: return None, "No ClinicalTrials.gov documents found."
 
@@ -948,10 +1210,8 @@ def generate_ct_gov_table(outcome_of_interest):
     for i, source_url in enumerate(ct_sources):
         progress_bar.progress((i + 1) / len(ct_sources), text=f"Processing API: {source_url}")
         
-        import re
-        nct_match = re.search(r'NCT\d+', source_url)
-        if nct_match:
-            nct_id = nct_match.group(0)
+        nct_id = extract_nct_id(source_url)
+        if nct_id:
             # Unpack 4 values now
             p_val, t_val, tab_name, dur_val = process_single_ct_gov_doc(nct_id, outcome_of_interest)
             
@@ -5,6 +5,7 @@ sys.modules['sqlite3'] = sys.modules.pop('pysqlite3')
 import streamlit as st
 #import os
 import requests
+from requests.adapters import HTTPAdapter
 import json
 import chromadb
 import uuid
@@ -14,6 +15,65 @@ from langchain_chroma import Chroma
 from langchain_core.documents import Document
 from langchain_core.embeddings import Embeddings
 import time
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+try:
+    import tiktoken
+    # Built once per process; constructing an encoder is too costly to repeat per batch.
+    TOKEN_ENCODER = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    # tiktoken missing (or its encoding file unreachable): fall back to a length estimate
+    TOKEN_ENCODER = None
+
+# Embeddings are unit-normalized at insert/query time, so an inner-product
+# index ranks exactly by cosine similarity (no per-query norm computation).
+COLLECTION_METADATA = {"hnsw:space": "ip"}
+
+def _normalize(embeddings):
+    """Scales each vector to unit length so inner product == cosine similarity."""
+    matrix = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (matrix / norms).tolist()
+
+# Token budget for one embedding request. Chunks are packed greedily up to this
+# limit; the safety margin covers tokenizer differences between cl100k and the model.
+MAX_BATCH_TOKENS = 8192
+BATCH_TOKEN_SAFETY = 256
+# Cap on inputs per request, independent of tokens (many short chunks still add up).
+MAX_BATCH_SIZE = 96
+# 413 (payload too large) is retried with the batch split in half.
+PAYLOAD_TOO_LARGE_STATUS = 413
+# 429 (rate limited) retries the same batch after Retry-After (or an exponential
+# backoff); splitting would only add requests while the API is throttling.
+RATE_LIMITED_STATUS = 429
+MAX_EMBED_RETRIES = 5
+# Total seconds one batch may spend sleeping on 429s before the error is raised,
+# so a throttled API can't hold the Add Chunks callback for minutes.
+MAX_RATE_LIMIT_WAIT = 30
+# If the provider rejects a batch outright, its chunks are embedded one per request instead.
+BATCH_REJECTED_STATUS_CODES = (400, 422)
+SINGLE_EMBED_WORKERS = 4
+# Packed batches are independent requests, so a document's batches are sent concurrently.
+EMBED_BATCH_WORKERS = 4
+# Chunk embeddings kept by content hash, so boilerplate shared across papers
+# (methods, consent language) is only sent to the API once. Entries are float32
+# arrays (~1.5 KB for 384 dims instead of ~12 KB as a list of floats). They are not
+# quantized: cache hits are written straight into Chroma, so they must be the exact
+# vectors a fresh API call would have stored.
+EMBEDDING_CACHE_SIZE = 20000
+
+def _retry_delay(response, attempt):
+    """Seconds to wait before retrying a 429: the server's Retry-After if given in seconds, else 2**attempt."""
+    retry_after = response.headers.get("Retry-After", "")
+    return float(retry_after) if retry_after.isdigit() else 2 ** attempt
+
+def _count_tokens(text):
+    if TOKEN_ENCODER is None:
+        return len(text) // 4 + 1
+    return len(TOKEN_ENCODER.encode(text))
 
 # --- Custom Hugging Face Embedding Class ---
 # This class calls the API directly using the correct endpoint and payload.
@@ -24,53 +84,131 @@ class DirectHuggingFaceEmbeddings(Embeddings):
         # --- THE FIX: Use the correct router endpoint you discovered ---
         self.api_url = f"https://router.huggingface.co/hf-inference/models/{self.model_name}/pipeline/feature-extraction"
         self.headers = {"Authorization": f"Bearer {self.api_key}"}
+        self._embedding_cache = {}
+        # The model is a cache_resource, so the prefetch, add, title-matching and table-cache
+        # paths of every session read and evict this cache concurrently.
+        self._cache_lock = threading.Lock()
+        # One pooled session for the client's lifetime, so embedding calls reuse TLS
+        # connections instead of handshaking per request. Sized for the concurrent workers.
+        self._session = requests.Session()
+        self._session.mount("https://", HTTPAdapter(pool_maxsize=EMBED_BATCH_WORKERS * SINGLE_EMBED_WORKERS))
 
-    def _embed(self, texts: list[str]) -> list[list[float]]:
-        """Helper function to call the API and get embeddings."""
+    def _embed(self, texts: list[str], attempt: int = 0, waited: float = 0.0) -> list[list[float]]:
+        """
+        Helper function to call the API and get embeddings.
+        Runs on worker threads, where st.* calls are dropped, so failures are raised
+        as ValueError for the script-thread caller to report.
+        """
         # The feature-extraction pipeline correctly uses the "inputs" key.
         payload = {"inputs": texts}
         
         try:
-            response = requests.post(self.api_url, headers=self.headers, json=payload, timeout=45)
+            response = self._session.post(self.api_url, headers=self.headers, json=payload, timeout=45)
+            if response.status_code == RATE_LIMITED_STATUS and attempt < MAX_EMBED_RETRIES:
+                delay = _retry_delay(response, attempt)
+                if waited + delay <= MAX_RATE_LIMIT_WAIT:
+                    time.sleep(delay)
+                    return self._embed(texts, attempt + 1, waited + delay)
+            if response.status_code == PAYLOAD_TOO_LARGE_STATUS and len(texts) > 1 and attempt < MAX_EMBED_RETRIES:
+                middle = len(texts) // 2
+                return self._embed(texts[:middle], attempt + 1, waited) + self._embed(texts[middle:], attempt + 1, waited)
+            if response.status_code in BATCH_REJECTED_STATUS_CODES and len(texts) > 1:
+                with ThreadPoolExecutor(max_workers=SINGLE_EMBED_WORKERS) as executor:
+                    singles = list(executor.map(self._embed_single, texts))
+                return [single[0] for single in singles]
             response.raise_for_status()
             embeddings = response.json()
             
             if isinstance(embeddings, list) and all(isinstance(e, list) for e in embeddings):
-                return embeddings
-            else:
-                st.error(f"Hugging Face API returned an unexpected format: {embeddings}")
-                return None
+                return _normalize(embeddings)
+            raise ValueError(f"Hugging Face API returned an unexpected format: {str(embeddings)[:300]}")
 
         except requests.exceptions.RequestException as e:
-            st.error(f"Hugging Face API request failed: {e}")
-            if e.response:
-                st.error(f"Response Status: {e.response.status_code}")
-                st.error(f"Response Body: {e.response.text}")
-            return None
+            message = f"Hugging Face API request failed: {e}"
+            if e.response is not None:
+                message += f" (status {e.response.status_code}: {e.response.text[:300]})"
+            raise ValueError(message) from e
         except json.JSONDecodeError:
-            st.error(f"Failed to decode JSON from API. Raw response: {response.text}")
-            return None
+            raise ValueError(f"Failed to decode JSON from API. Raw response: {response.text[:300]}")
+
+    def _embed_single(self, text: str) -> list[list[float]]:
+        """One-chunk request for a rejected batch; a failure names the chunk that was refused."""
+        try:
+            return self._embed([text])
+        except ValueError as e:
+            raise ValueError(f"Chunk '{text[:80].strip()}...' could not be embedded: {e}") from e
 
-    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+    def _pack_batches(self, texts: list[str]) -> list[list[str]]:
+        """Greedily groups texts into batches that stay under the token and size limits."""
+        budget = MAX_BATCH_TOKENS - BATCH_TOKEN_SAFETY
+        batches, current_batch, current_tokens = [], [], 0
+        for text in texts:
+            text_tokens = _count_tokens(text)
+            if current_batch and (current_tokens + text_tokens > budget or len(current_batch) >= MAX_BATCH_SIZE):
+                batches.append(current_batch)
+                current_batch, current_tokens = [], 0
+            current_batch.append(text)
+            current_tokens += text_tokens
+        if current_batch:
+            batches.append(current_batch)
+        return batches
+
+    def embed_documents(self, texts: list[str], on_progress=None) -> list[list[float]]:
         """
-        Embed a list of documents by sending them all in a single API call (batching).
-        This is much faster than one-by-one processing.
+        Embed a list of documents in as few API calls as the token budget allows.
+        Each call carries as many chunks as fit under MAX_BATCH_TOKENS, the calls
+        run concurrently, and each distinct chunk text is only embedded once.
+        `on_progress(fraction, text=...)` is called as each batch comes back.
+        Raises ValueError if any batch fails; nothing is reported with st.* here,
+        since this also runs off the script thread (e.g. the embedding prefetch).
         """
-        # The _embed function is already designed to handle a list of texts.
-        # We can simply call it directly with the full list.
-        embeddings = self._embed(texts)
-        
-        if embeddings and len(embeddings) == len(texts):
-            return embeddings
-        else:
-            # If the call fails or returns a mismatched number of embeddings, return None.
-            st.error("Failed to generate embeddings for the batch of documents.")
-            return None
+        keys = [hashlib.blake2b(text.encode(), digest_size=16).digest() for text in texts]
+        with self._cache_lock:
+            cached = [self._embedding_cache.get(key) for key in keys]
+        embeddings = [entry.tolist() if entry is not None else None for entry in cached]
+
+        # Only chunks that are neither cached nor repeated earlier in this call go to the API
+        pending = {}
+        for key, text, embedding in zip(keys, texts, embeddings):
+            if embedding is None:
+                pending.setdefault(key, text)
+
+        # Length-sorted, so each batch holds chunks of similar size and packs tightly;
+        # vectors are keyed by content hash, which restores the original order below.
+        pending = dict(sorted(pending.items(), key=lambda item: len(item[1])))
+        fresh = {}
+        pending_keys = list(pending)
+        batches = self._pack_batches(list(pending.values()))
+        # Batches are packed in key order, so each batch's keys are the next len(batch) of them
+        batch_keys, start = [], 0
+        for batch in batches:
+            batch_keys.append(pending_keys[start:start + len(batch)])
+            start += len(batch)
+        # Results are taken as each batch finishes, so progress moves per completed batch
+        with ThreadPoolExecutor(max_workers=EMBED_BATCH_WORKERS) as executor:
+            futures = {executor.submit(self._embed, batch): i for i, batch in enumerate(batches)}
+            for done, future in enumerate(as_completed(futures), start=1):
+                i = futures[future]
+                batch_embeddings = future.result()
+                if len(batch_embeddings) != len(batches[i]):
+                    raise ValueError(f"Embedding API returned {len(batch_embeddings)} vectors for {len(batches[i])} chunks.")
+                fresh.update(zip(batch_keys[i], batch_embeddings))
+                if on_progress:
+                    on_progress(done / len(batches), text=f"Embedded batch {done}/{len(batches)}")
+
+        # Fan the new vectors back out to every position that shares the text
+        embeddings = [embedding if embedding is not None else fresh[key] for key, embedding in zip(keys, embeddings)]
+        entries = {key: np.asarray(embedding, dtype=np.float32) for key, embedding in fresh.items()}
+        with self._cache_lock:
+            for key, entry in entries.items():
+                if len(self._embedding_cache) >= EMBEDDING_CACHE_SIZE:
+                    self._embedding_cache.pop(next(iter(self._embedding_cache)))
+                self._embedding_cache[key] = entry
+        return embeddings
 
     def embed_query(self, text: str) -> list[float]:
-        """Embed a single query."""
-        result = self._embed([text])
-        return result[0] if result else []
+        """Embed a single query. Raises ValueError if the API call fails."""
+        return self._embed([text])[0]
 
 # --- END Custom Class ---
 
@@ -90,82 +228,159 @@ def get_embedding_model():
         st.error(f"Failed to initialize embedding model: {e}")
         return None
 
-def create_in_memory_vector_store(text_chunks, source_url):
+@st.cache_resource
+def get_chroma_client():
+    """
+    One in-memory Chroma client per process. Each library still gets its own
+    uniquely named collection, so sessions never see each other's chunks.
+    """
+    return chromadb.EphemeralClient()
+
+def _chunks_to_documents(text_chunks, source_url):
+    """
+    Builds one Document per distinct chunk text. Repeated chunks within a paper
+    (boilerplate, duplicated captions) would only crowd out retrieval results.
+    """
+    documents = {}
+    for text, section in zip(text_chunks.texts, text_chunks.sections):
+        key = hashlib.blake2b(text.encode(), digest_size=16).digest()
+        if key not in documents:
+            documents[key] = Document(
+                page_content=text,
+                metadata={"source": source_url, "section": section or "Unknown"}
+            )
+    return list(documents.values())
+
+# Rows per collection.add call: one call per slice, well under Chroma's max batch size.
+CHROMA_ADD_BATCH_SIZE = 250
+
+def _document_id(doc):
+    """Content-derived id, so the same chunk from the same source always maps to the same row."""
+    key = f"{doc.metadata['source']}\n{doc.page_content}"
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+def _add_documents(vector_store, documents, embedding_model, on_progress=None):
+    """
+    Embeds all documents in one embed_documents call, then writes them with
+    plain collection.add calls (no per-row upsert lookups) in fixed-size slices.
+    Chunks already in the collection (e.g. a link added twice) are skipped
+    before embedding. Returns the number of chunks written.
+    """
+    ids = [_document_id(doc) for doc in documents]
+    existing = set(vector_store._collection.get(ids=ids, include=[])["ids"])
+    if existing:
+        documents = [doc for doc, doc_id in zip(documents, ids) if doc_id not in existing]
+        ids = [doc_id for doc_id in ids if doc_id not in existing]
+    if not documents:
+        return 0
+
+    texts = [doc.page_content for doc in documents]
+    # Raises on failure; create/add turn the error into the status message shown to the user
+    embeddings = embedding_model.embed_documents(texts, on_progress=on_progress)
+    metadatas = [doc.metadata for doc in documents]
+    for start in range(0, len(documents), CHROMA_ADD_BATCH_SIZE):
+        end = start + CHROMA_ADD_BATCH_SIZE
+        vector_store._collection.add(
+            ids=ids[start:end],
+            embeddings=embeddings[start:end],
+            metadatas=metadatas[start:end],
+            documents=texts[start:end]
+        )
+    return len(documents)
+
+def create_in_memory_vector_store(text_chunks, source_url, on_progress=None):
     """
     Creates a new, truly ephemeral in-memory vector store.
     This will be stored in the user's session state.
+    `text_chunks` is the Chunks(texts, sections) tuple from data_ingestor.chunk_text.
+    `on_progress(fraction, text=...)` receives embedding progress (e.g. st.progress().progress).
     """
-    if not text_chunks:
+    if not text_chunks or not text_chunks.texts:
         return None, "No text chunks provided."
     
-    documents = [
-        Document(
-            page_content=chunk["text"], 
-            metadata={"source": source_url, "section": chunk.get("section", "Unknown")}
-        ) for chunk in text_chunks
-    ]
+    documents = _chunks_to_documents(text_chunks, source_url)
     
     try:
         embedding_model = get_embedding_model()
         if not embedding_model:
             return None, "Embedding model could not be initialized."
         
-        # --- THE FIX: Create a truly ephemeral client ---
-        # This guarantees we get a fresh, empty database every time.
-        client = chromadb.EphemeralClient()
-        # --- END FIX ---
+        client = get_chroma_client()
 
-        # Create the vector store using the new, empty client
+        # Create the vector store in a new, empty collection
         # Generate a unique collection name
         collection_name = f"collection_{uuid.uuid4().hex}"
-        vector_store = Chroma.from_documents(
-            documents=documents,
-            embedding=embedding_model,
+        vector_store = Chroma(
+            embedding_function=embedding_model,
             client=client,
-            collection_name=collection_name  # Specify unique collection name
+            collection_name=collection_name,  # Specify unique collection name
+            collection_metadata=COLLECTION_METADATA
         )
+        _add_documents(vector_store, documents, embedding_model, on_progress)
         
         # Store the entire vector store object in the session state
         st.session_state['vector_store'] = vector_store
+        # Track sources and size alongside the store so pages don't have to query Chroma for them
+        st.session_state['sources_set'] = {source_url}
+        st.session_state['chunk_count'] = len(documents)
         
         return vector_store, f"Added {len(documents)} chunks to the in-memory knowledge library."
     except Exception as e:
         return None, f"Failed to create in-memory vector store: {e}"
 
-def add_to_in_memory_vector_store(text_chunks, source_url):
+def add_to_in_memory_vector_store(text_chunks, source_url, on_progress=None):
     """
     Adds new documents to an existing in-memory vector store.
     """
     if 'vector_store' not in st.session_state or st.session_state['vector_store'] is None:
         # If no store exists, create a new one
-        return create_in_memory_vector_store(text_chunks, source_url)
+        return create_in_memory_vector_store(text_chunks, source_url, on_progress)
 
-    if not text_chunks:
+    if not text_chunks or not text_chunks.texts:
         return None, "No text chunks provided."
 
-    documents = [
-        Document(
-            page_content=chunk["text"], 
-            metadata={"source": source_url, "section": chunk.get("section", "Unknown")}
-        ) for chunk in text_chunks
-    ]
+    documents = _chunks_to_documents(text_chunks, source_url)
 
     try:
         # Get the existing store from session state and add documents
         vector_store = st.session_state['vector_store']
-        vector_store.add_documents(documents)
+        # Read before the insert: the count() fallback would already include the new rows
+        chunk_count = get_library_chunk_count(vector_store)
+        added = _add_documents(vector_store, documents, vector_store.embeddings, on_progress)
+        get_library_source_set(vector_store).add(source_url)
+        st.session_state['chunk_count'] = chunk_count + added
         
-        return vector_store, f"Added {len(documents)} chunks to the in-memory knowledge library."
+        return vector_store, f"Added {added} chunks to the in-memory knowledge library."
     except Exception as e:
         return None, f"Failed to add to in-memory vector store: {e}"
 
 def clear_in_memory_vector_store():
     # Remove the vector store from session
     if 'vector_store' in st.session_state:
-        del st.session_state['vector_store']
+        vector_store = st.session_state.pop('vector_store')
+        if vector_store is not None:
+            # The client is shared and long-lived, so drop the collection rather than leak it
+            vector_store.delete_collection()
 
     # Also clean up other processing state
-    for key in ['processed_text', 'processed_chunks', 'processed_link']:
+    for key in ['sources_set', 'chunk_count', 'processed_chunks', 'processed_link']:
         if key in st.session_state:
             del st.session_state[key]
     return True, "In-memory knowledge library cleared and reinitialized."
+
+def get_library_source_set(vector_store):
+    """
+    Returns the set of source URLs in the library, as tracked by the add/create
+    helpers above. Only scans the store's metadata when the set is missing
+    (e.g. a store from an older session).
+    """
+    if 'sources_set' not in st.session_state:
+        all_docs_metadata = vector_store.get(include=["metadatas"])
+        st.session_state['sources_set'] = {meta['source'] for meta in all_docs_metadata['metadatas']}
+    return st.session_state['sources_set']
+
+def get_library_chunk_count(vector_store):
+    """Returns the number of chunks in the library, tracked on add; falls back to Chroma's count."""
+    if 'chunk_count' not in st.session_state:
+        st.session_state['chunk_count'] = vector_store._collection.count()
+    return st.session_state['chunk_count']